@@ -32,6 +32,18 @@ if curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeM
         echo "Note: No bundled secrets found in Secret Manager (cloudvolume-secrets)"
         echo "Will attempt to use VM service account for authentication"
     fi
+
+    # Fetch the materialization database URI from Secret Manager, if the job names a
+    # secret holding it, so the password never appears in the job config
+    if [ -n "$MAT_DB_URI_SECRET" ] && [ -z "$MAT_DB_URI" ]; then
+        if MAT_DB_URI=$(gcloud secrets versions access latest --secret="$MAT_DB_URI_SECRET" 2>/dev/null); then
+            export MAT_DB_URI
+            echo "✓ Database URI fetched from Secret Manager ($MAT_DB_URI_SECRET)"
+        else
+            unset MAT_DB_URI
+            echo "Warning: Could not fetch database URI from Secret Manager ($MAT_DB_URI_SECRET)"
+        fi
+    fi
 fi
 
 # Activate Google Cloud service account if credentials file exists
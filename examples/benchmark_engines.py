@@ -0,0 +1,172 @@
+"""
+Time the same queries on each query engine, side by side.
+
+Runs a point lookup, a wide aggregation and a join on a table with every available
+engine, checks that they agree, and records the median times to
+`engine_timings.json`, which `run_query(..., engine="auto")` picks engines from.
+"""
+
+# %%
+import json
+import os
+import statistics
+import time
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from query_engines import (
+    DEFAULT_TIMINGS_PATH,
+    ENGINES,
+    ColumnRef,
+    available_engines,
+    classify_query,
+    load_timings,
+)
+
+# %%
+
+# PARAMETERS
+# ----------
+
+table_path = os.getenv(
+    "TABLE_PATH",
+    "gs://allen-minnie-phase3/mat_deltalakes/v1412/synapses_pni_2_v1412_deltalake",
+)
+
+# column the table is partitioned by, and the column holding its partition
+partition_column = os.getenv("PARTITION_COLUMN", "post_pt_root_id")
+partition_by = f"{partition_column}_partition"
+
+# the other root id column of a synapse table, compared to the partition column to
+# remove autapses
+other_root_column = (
+    "pre_pt_root_id" if partition_column == "post_pt_root_id" else "post_pt_root_id"
+)
+
+# number of ids to look up, and number of partitions to aggregate over
+n_lookup_ids = int(os.getenv("N_LOOKUP_IDS", "50"))
+n_aggregation_partitions = int(os.getenv("N_AGGREGATION_PARTITIONS", "16"))
+
+# number of times to run each query on each engine, the median is recorded
+n_repeats = int(os.getenv("N_REPEATS", "3"))
+
+timings_path = os.getenv("TIMINGS_PATH", str(DEFAULT_TIMINGS_PATH))
+
+engines = available_engines()
+print(f"Benchmarking engines: {engines}")
+print()
+
+# set up each engine before timing it, so that e.g. loading DuckDB's delta extension
+# isn't timed as part of its first query
+for engine in engines:
+    if hasattr(ENGINES[engine], "connect"):
+        ENGINES[engine].connect()
+
+# %%
+# pick ids to query from a single partition, which is cheap to read
+
+ids = (
+    pl.scan_delta(table_path)
+    .filter(pl.col(partition_by) == 0)
+    .select(partition_column)
+    .unique()
+    .head(n_lookup_ids)
+    .collect(engine="streaming")[partition_column]
+    .to_list()
+)
+partitions = list(range(n_aggregation_partitions))
+
+# a small table of labels for the ids, standing in for e.g. cell types
+labels = pl.DataFrame(
+    {partition_column: ids, "label": [i % 4 for i in range(len(ids))]}
+)
+
+queries = {
+    "point_lookup": dict(
+        filters=[
+            (partition_column, "in", ids),
+            (partition_by, "in", [0]),
+            (partition_column, "!=", ColumnRef(other_root_column)),
+        ],
+        columns=["id", "pre_pt_root_id", "post_pt_root_id", "size"],
+    ),
+    "aggregation": dict(
+        filters=[(partition_by, "in", partitions)],
+        group_by=[partition_column],
+        aggs={
+            "n_synapses": ("count", None),
+            "mean_size": ("mean", "size"),
+        },
+    ),
+    "join": dict(
+        filters=[
+            (partition_column, "in", ids),
+            (partition_by, "in", [0]),
+        ],
+        joins=[(labels, partition_column, "inner")],
+        group_by=["label"],
+        aggs={"n_synapses": ("count", None)},
+    ),
+}
+
+# %%
+
+results = []
+for name, query in queries.items():
+    query_kind = classify_query(query.get("group_by"), query.get("joins"))
+    outputs = {}
+    for engine in engines:
+        seconds = []
+        for _ in range(n_repeats):
+            currtime = time.time()
+            out = ENGINES[engine].execute(table_path, **query)
+            seconds.append(time.time() - currtime)
+        outputs[engine] = out
+        results.append(
+            {
+                "query": name,
+                "query_kind": query_kind,
+                "engine": engine,
+                "median_seconds": statistics.median(seconds),
+                "min_seconds": min(seconds),
+                "n_rows": out.height,
+            }
+        )
+    # compared regardless of row order and integer widths, e.g. counts are UInt32 from
+    # polars and Int64 from duckdb
+    first_engine, first_out = next(iter(outputs.items()))
+    for engine, out in outputs.items():
+        try:
+            assert_frame_equal(
+                first_out, out, check_row_order=False, check_dtypes=False
+            )
+        except AssertionError as e:
+            print(
+                f"Warning: {engine} and {first_engine} returned different results for "
+                f"{name}: {e}"
+            )
+
+results = pl.DataFrame(results)
+
+print(
+    results.pivot(on="engine", index="query", values="median_seconds").with_columns(
+        pl.exclude("query").round(3)
+    )
+)
+print()
+
+# %%
+# record the timings for engine="auto" to pick from
+
+timings = load_timings(timings_path)
+table_timings = timings.setdefault(table_path, {})
+for row in results.iter_rows(named=True):
+    table_timings.setdefault(row["query_kind"], {})[row["engine"]] = row[
+        "median_seconds"
+    ]
+
+with open(timings_path, "w") as f:
+    json.dump(timings, f, indent=2, sort_keys=True)
+
+print(f"Recorded timings to {timings_path}")
@@ -0,0 +1,397 @@
+"""
+Run the same table queries on different query engines.
+
+Queries are described by plain filters, joins, columns and aggregations, so that each
+engine can compile them in its own way:
+
+- "polars": `pl.scan_delta` with the streaming engine
+- "duckdb": DuckDB's `delta_scan`, from the delta extension
+
+With `engine="auto"`, the engine is picked for each query from timings recorded by
+`benchmark_engines.py` for the kind of query it is.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import polars as pl
+
+# where benchmark_engines.py records timings, read when picking an engine
+DEFAULT_TIMINGS_PATH = Path(__file__).parent / "engine_timings.json"
+
+# engine to use when there are no timings for a kind of query
+DEFAULT_ENGINE = "polars"
+
+# operators which can be used in filters, other than "in"
+COMPARISON_OPERATORS = {"==", "!=", ">", ">=", "<", "<="}
+
+# aggregations which can be used, and their DuckDB equivalents. "count" counts rows and
+# ignores its column, "std" is the sample standard deviation as in polars.
+AGGREGATIONS = {
+    "count": "count(*)",
+    "sum": "sum({})",
+    "mean": "avg({})",
+    "std": "stddev_samp({})",
+    "min": "min({})",
+    "max": "max({})",
+}
+
+# join types and their DuckDB equivalents
+DUCKDB_JOINS = {"inner": "JOIN", "left": "LEFT JOIN", "semi": "SEMI JOIN"}
+
+
+class ColumnRef(NamedTuple):
+    """A reference to another column, for comparing two columns in a filter."""
+
+    name: str
+
+
+def classify_query(group_by=None, joins=None) -> str:
+    """
+    Get the kind of query, which engines are benchmarked and picked by.
+
+    One of "join" for queries joining other tables, "aggregation" for grouped
+    aggregations, or "point_lookup" for filtering rows.
+    """
+    if joins:
+        return "join"
+    if group_by:
+        return "aggregation"
+    return "point_lookup"
+
+
+def load_timings(timings_path=DEFAULT_TIMINGS_PATH) -> dict:
+    """Load recorded benchmark timings, or an empty dict if there are none."""
+    timings_path = Path(timings_path)
+    if not timings_path.exists():
+        return {}
+    return json.loads(timings_path.read_text())
+
+
+def available_engines() -> list[str]:
+    """Get the engines which can be used in this environment."""
+    engines = ["polars"]
+    try:
+        import duckdb  # noqa: F401
+
+        engines.append("duckdb")
+    except ImportError:
+        pass
+    return engines
+
+
+def choose_engine(table_path: str, query_kind: str, timings: dict | None = None) -> str:
+    """
+    Pick the engine with the fastest recorded median time for a kind of query.
+
+    Timings for the table itself are used if there are any, otherwise timings for any
+    table. Falls back to `DEFAULT_ENGINE` if no engine has been timed.
+
+    Parameters
+    ----------
+    table_path : str
+        Table being queried.
+    query_kind : str
+        Output of `classify_query`.
+    timings : dict, optional
+        Maps table paths to query kinds to engines to median seconds, as recorded by
+        `benchmark_engines.py`. Loaded from `DEFAULT_TIMINGS_PATH` if not given.
+    """
+    if timings is None:
+        timings = load_timings()
+    engines = available_engines()
+
+    if table_path in timings:
+        candidates = timings[table_path].get(query_kind, {})
+    else:
+        # pool timings across tables, keeping the fastest seen for each engine
+        candidates = {}
+        for table_timings in timings.values():
+            for engine, seconds in table_timings.get(query_kind, {}).items():
+                candidates[engine] = min(seconds, candidates.get(engine, seconds))
+
+    candidates = {
+        engine: seconds for engine, seconds in candidates.items() if engine in engines
+    }
+    if len(candidates) == 0:
+        return DEFAULT_ENGINE
+    return min(candidates, key=candidates.get)
+
+
+class PolarsEngine:
+    """Runs queries with `pl.scan_delta` and the streaming engine."""
+
+    name = "polars"
+
+    def execute(
+        self,
+        table_path: str,
+        filters=None,
+        columns=None,
+        joins=None,
+        group_by=None,
+        aggs=None,
+    ) -> pl.DataFrame:
+        table = pl.scan_delta(table_path)
+
+        for column, op, value in filters or []:
+            table = table.filter(self._filter_expr(column, op, value))
+
+        for other, on, how in joins or []:
+            table = table.join(other.lazy(), on=on, how=how)
+
+        if group_by:
+            table = table.group_by(group_by).agg(
+                [self._agg_expr(alias, fn, col) for alias, (fn, col) in aggs.items()]
+            )
+        elif columns is not None:
+            table = table.select(columns)
+
+        return table.collect(engine="streaming")
+
+    @staticmethod
+    def _filter_expr(column: str, op: str, value) -> pl.Expr:
+        if op == "in":
+            return pl.col(column).is_in(list(value))
+        if op not in COMPARISON_OPERATORS:
+            raise ValueError(f"Unrecognized filter operator: {op!r}")
+        other = pl.col(value.name) if isinstance(value, ColumnRef) else pl.lit(value)
+        return {
+            "==": pl.col(column) == other,
+            "!=": pl.col(column) != other,
+            ">": pl.col(column) > other,
+            ">=": pl.col(column) >= other,
+            "<": pl.col(column) < other,
+            "<=": pl.col(column) <= other,
+        }[op]
+
+    @staticmethod
+    def _agg_expr(alias: str, fn: str, col: str | None) -> pl.Expr:
+        if fn == "count":
+            return pl.len().alias(alias)
+        if fn not in AGGREGATIONS:
+            raise ValueError(f"Unrecognized aggregation: {fn!r}")
+        return getattr(pl.col(col), fn)().alias(alias)
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value) -> str:
+    if hasattr(value, "item"):
+        # numpy scalars, as the plain python value
+        value = value.item()
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class DuckDBEngine:
+    """
+    Runs queries with DuckDB's `delta_scan`.
+
+    Parameters
+    ----------
+    setup_sql : list of str, optional
+        Statements to run when the connection is opened, e.g. `CREATE SECRET ...` to
+        give access to a bucket. Defaults to the semicolon-separated statements in the
+        `DUCKDB_SETUP_SQL` environment variable.
+    """
+
+    name = "duckdb"
+
+    def __init__(self, setup_sql: list[str] | None = None):
+        if setup_sql is None:
+            setup_sql = [
+                statement.strip()
+                for statement in os.getenv("DUCKDB_SETUP_SQL", "").split(";")
+                if statement.strip()
+            ]
+        self.setup_sql = setup_sql
+        self._connection = None
+
+    def connect(self):
+        """
+        Get the engine's connection, opening it the first time it's needed.
+
+        Loading the delta extension and running `setup_sql` is done once per engine
+        rather than once per query, since it would dominate the time of small queries.
+        """
+        if self._connection is not None:
+            return self._connection
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError(
+                "The duckdb engine requires the `duckdb` extra, e.g. "
+                "`uv sync --extra duckdb`."
+            ) from e
+        connection = duckdb.connect()
+        connection.install_extension("delta")
+        connection.load_extension("delta")
+        for statement in self.setup_sql:
+            connection.execute(statement)
+        self._connection = connection
+        return connection
+
+    def build_sql(
+        self,
+        table_path: str,
+        filters=None,
+        columns=None,
+        joins=None,
+        group_by=None,
+        aggs=None,
+    ) -> tuple[str, dict]:
+        """
+        Compile a query to SQL.
+
+        Returns the SQL, and the dataframes to register under the names the SQL joins
+        them by.
+        """
+        escaped_path = table_path.replace("'", "''")
+
+        # filter values are inlined as constants rather than bound as parameters, since
+        # duckdb only pushes constant filters down into delta_scan to prune partitions
+        # and skip files. A bound IN list is planned as a join against the whole table.
+        conditions = []
+        for column, op, value in filters or []:
+            col = f"t.{_quote(column)}"
+            if op == "in":
+                values = pl.Series(value).to_list()
+                if len(values) == 0:
+                    conditions.append("FALSE")
+                else:
+                    literals = ", ".join(_literal(v) for v in values)
+                    conditions.append(f"{col} IN ({literals})")
+            elif op in COMPARISON_OPERATORS:
+                op = "=" if op == "==" else op
+                if isinstance(value, ColumnRef):
+                    conditions.append(f"{col} {op} t.{_quote(value.name)}")
+                else:
+                    conditions.append(f"{col} {op} {_literal(value)}")
+            else:
+                raise ValueError(f"Unrecognized filter operator: {op!r}")
+
+        join_clauses = []
+        registered = {}
+        for i, (other, on, how) in enumerate(joins or []):
+            name = f"join_{i}"
+            registered[name] = other
+            on = [on] if isinstance(on, str) else list(on)
+            using = ", ".join(_quote(col) for col in on)
+            join_clauses.append(f"{DUCKDB_JOINS[how]} {name} USING ({using})")
+
+        if group_by:
+            keys = ", ".join(_quote(col) for col in group_by)
+            selects = [keys]
+            for alias, (fn, col) in aggs.items():
+                if fn not in AGGREGATIONS:
+                    raise ValueError(f"Unrecognized aggregation: {fn!r}")
+                expr = AGGREGATIONS[fn].format(_quote(col) if col else "")
+                selects.append(f"{expr} AS {_quote(alias)}")
+            select = ", ".join(selects)
+        elif columns is not None:
+            select = ", ".join(_quote(col) for col in columns)
+        else:
+            select = "*"
+
+        sql = f"SELECT {select} FROM delta_scan('{escaped_path}') AS t"
+        if join_clauses:
+            sql += " " + " ".join(join_clauses)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if group_by:
+            sql += f" GROUP BY {keys}"
+
+        return sql, registered
+
+    def execute(
+        self,
+        table_path: str,
+        filters=None,
+        columns=None,
+        joins=None,
+        group_by=None,
+        aggs=None,
+    ) -> pl.DataFrame:
+        sql, registered = self.build_sql(
+            table_path,
+            filters=filters,
+            columns=columns,
+            joins=joins,
+            group_by=group_by,
+            aggs=aggs,
+        )
+        # a cursor shares the connection's extensions and secrets, but keeps the
+        # dataframes registered for this query to itself
+        cursor = self.connect().cursor()
+        try:
+            for name, other in registered.items():
+                cursor.register(name, other)
+            return cursor.execute(sql).pl()
+        finally:
+            cursor.close()
+
+
+ENGINES = {"polars": PolarsEngine(), "duckdb": DuckDBEngine()}
+
+
+def run_query(
+    table_path: str,
+    filters=None,
+    columns=None,
+    joins=None,
+    group_by=None,
+    aggs=None,
+    engine: str = "auto",
+    timings: dict | None = None,
+) -> pl.DataFrame:
+    """
+    Run a query on a deltalake table.
+
+    Parameters
+    ----------
+    table_path : str
+        Location of the table.
+    filters : list of (str, str, object), optional
+        Filters which rows must all pass, as `(column, op, value)`. `op` is "in", for
+        which `value` is a list, or a comparison operator, for which `value` is a
+        scalar or a `ColumnRef` to compare against another column.
+    columns : list of str, optional
+        Columns to return, all of them if not given. Ignored if `group_by` is given.
+    joins : list of (pl.DataFrame, str or list of str, str), optional
+        Dataframes to join to the table, as `(other, on, how)` where `how` is
+        "inner", "left" or "semi".
+    group_by : list of str, optional
+        Columns to group by before aggregating.
+    aggs : dict, optional
+        Maps output column names to `(function, column)`, where function is one of
+        "count", "sum", "mean", "std", "min" or "max". The column is ignored for
+        "count".
+    engine : str
+        "polars", "duckdb", or "auto" to pick from recorded timings, see
+        `choose_engine`.
+    timings : dict, optional
+        Recorded timings to pick from when `engine` is "auto".
+    """
+    if engine == "auto":
+        engine = choose_engine(table_path, classify_query(group_by, joins), timings)
+    if engine not in ENGINES:
+        valid = ", ".join(["auto"] + sorted(ENGINES))
+        raise ValueError(f"Unrecognized engine: {engine!r}. Valid options: {valid}")
+    return ENGINES[engine].execute(
+        table_path,
+        filters=filters,
+        columns=columns,
+        joins=joins,
+        group_by=group_by,
+        aggs=aggs,
+    )
@@ -1,8 +1,12 @@
 # %%
+import json
 import time
 
 import polars as pl
 from caveclient import CAVEclient
+from deltalake import DeltaTable
+
+from query_engines import ColumnRef, run_query
 
 client = CAVEclient("minnie65_phase3_v1")
 
@@ -43,51 +47,204 @@ pl.scan_delta(
 # %%
 
 
+def get_table_layout(table_path):
+    """
+    Get the layout recorded on a table when it was written, or an empty dict for
+    tables written before layouts were recorded.
+    """
+    configuration = DeltaTable(table_path).metadata().configuration
+    if "registry.layout" not in configuration:
+        return {}
+    return json.loads(configuration["registry.layout"])
+
+
+def get_n_partitions(table_path, partition_by):
+    """
+    Get the number of partitions a table was written with from the largest partition
+    value in it, or None if it isn't partitioned by `partition_by`.
+
+    This assumes the last partition isn't empty, which holds for any table with many
+    more ids than partitions.
+    """
+    dt = DeltaTable(table_path)
+    if partition_by not in dt.metadata().partition_columns:
+        return None
+    return max(int(partition[partition_by]) for partition in dt.partitions()) + 1
+
+
+table_layout = get_table_layout(table_path)
+
+# set to the number of partitions the table was written with, to override the recorded
+# or derived number
+n_post_partitions = None
+
+# each id's partition is the id modulo the number of partitions, so guessing the number
+# wrong would silently filter out the partitions holding the ids. Tables written before
+# layouts were recorded fall back to the partitions actually in the table
+if n_post_partitions is None:
+    n_post_partitions = table_layout.get("n_partitions")
+if n_post_partitions is None:
+    n_post_partitions = get_n_partitions(table_path, "post_pt_root_id_partition")
+if n_post_partitions is None:
+    raise ValueError(
+        f"No layout is recorded on {table_path} and it isn't partitioned by "
+        "post_pt_root_id_partition, so its number of partitions is unknown. Set "
+        "n_post_partitions to the number it was written with."
+    )
+
+
+# operations which rewrite or clean up a table's files without changing its rows
+NON_DATA_OPERATIONS = {"OPTIMIZE", "VACUUM START", "VACUUM END", "SET TBLPROPERTIES"}
+
+
+def get_last_data_version(table_path, limit=16):
+    """
+    Get the version of the last commit which changed a table's rows, or None if none
+    is left in the table's history.
+    """
+    dt = DeltaTable(table_path)
+    # the last data change is usually among the latest few commits, so only read more
+    # of the history if it isn't
+    while True:
+        history = dt.history(limit=limit)
+        for commit in history:
+            if commit.get("operation") not in NON_DATA_OPERATIONS:
+                return commit["version"]
+        if len(history) < limit:
+            return None
+        limit *= 4
+
+
+def is_up_to_date(access_path):
+    """
+    Check that a secondary copy of the table mirrors the main table's latest rows,
+    i.e. nothing has been appended to the main table since the copy was written.
+    """
+    configuration = DeltaTable(access_path["path"]).metadata().configuration
+    primary_version = configuration.get("registry.primary_version")
+    if primary_version is None:
+        return False
+    last_data_version = get_last_data_version(table_path)
+    return last_data_version is not None and last_data_version <= int(primary_version)
+
+
+def get_access_path(partition_column, columns):
+    """
+    Find a secondary copy of the table partitioned by `partition_column` which has all
+    of `columns` and is up to date with the main table, or None if there isn't one.
+    """
+    for access_path in table_layout.get("secondary_access_paths", []):
+        if (
+            access_path["partition_column"] == partition_column
+            and set(columns).issubset(access_path["columns"])
+            and is_up_to_date(access_path)
+        ):
+            return access_path
+    return None
+
+
+def partitioned_id_filters(column, ids, partition_by, n_partitions):
+    """
+    Filters for rows where `column` is in `ids`, also filtering on the partition column
+    so that only the partitions holding those ids are read.
+    """
+    id_list = [ids] if isinstance(ids, (int,)) else list(ids)
+    partition_list = list({root_id % n_partitions for root_id in id_list})
+    return [(column, "in", id_list), (partition_by, "in", partition_list)]
+
+
 def synapse_query(
     pre_ids=None,
     post_ids=None,
     bounding_box=None,
     bounding_box_column="post_pt_position",
     remove_autapses=True,
+    columns=None,
+    engine="auto",
 ):
-    table = pl.scan_delta(table_path)
-
+    # which columns the query needs to read, to check whether a secondary copy of the
+    # table can answer it
+    if columns is None:
+        needed_columns = pl.scan_delta(table_path).collect_schema().names()
+    else:
+        needed_columns = list(columns)
     if remove_autapses:
-        table = table.filter(pl.col("post_pt_root_id") != pl.col("pre_pt_root_id"))
-
-    if pre_ids is not None:
-        pre_list = [pre_ids] if isinstance(pre_ids, (int,)) else list(pre_ids)
-        table = table.filter(pl.col("pre_pt_root_id").is_in(pre_list))
-
-    if post_ids is not None:
-        post_list = [post_ids] if isinstance(post_ids, (int,)) else list(post_ids)
-        partition_list = [root_id % 1024 for root_id in post_list]
-        join_index = pl.DataFrame(
-            {"post_pt_root_id": post_list, "post_pt_root_id_partition": partition_list}
-        ).lazy()
-        table = table.filter(
-            pl.col("post_pt_root_id").is_in(post_list),
-            pl.col("post_pt_root_id_partition").is_in(partition_list),
+        needed_columns += ["pre_pt_root_id", "post_pt_root_id"]
+    if bounding_box is not None:
+        needed_columns += [f"{bounding_box_column}_{dim}" for dim in "xyz"]
+
+    # queries on only presynaptic ids can't use the main table's partitioning on
+    # post_pt_root_id, so use a copy partitioned by pre_pt_root_id if there is one and
+    # it hasn't fallen behind the main table
+    pre_access_path = None
+    pre_lookup_path = None
+    if pre_ids is not None and post_ids is None:
+        pre_access_path = get_access_path("pre_pt_root_id", needed_columns)
+        pre_lookup_path = get_access_path(
+            "pre_pt_root_id", ["id", "pre_pt_root_id", "post_pt_root_id"]
         )
-        table = table.join(
-            join_index, on=["post_pt_root_id", "post_pt_root_id_partition"], how="semi"
+
+    query_path = table_path
+    filters = []
+    joins = None
+    if pre_access_path is not None:
+        query_path = pre_access_path["path"]
+        filters += partitioned_id_filters(
+            "pre_pt_root_id",
+            pre_ids,
+            pre_access_path["partition_by"],
+            pre_access_path["n_partitions"],
         )
+        if columns is None:
+            columns = pre_access_path["columns"]
+    elif pre_lookup_path is not None:
+        # the copy doesn't have every column needed, but it can still find which
+        # synapses and postsynaptic ids to look up in the main table
+        lookup = run_query(
+            pre_lookup_path["path"],
+            filters=partitioned_id_filters(
+                "pre_pt_root_id",
+                pre_ids,
+                pre_lookup_path["partition_by"],
+                pre_lookup_path["n_partitions"],
+            ),
+            columns=["id", "post_pt_root_id"],
+            engine=engine,
+        )
+        filters += partitioned_id_filters(
+            "post_pt_root_id",
+            lookup["post_pt_root_id"].unique().to_list(),
+            "post_pt_root_id_partition",
+            n_post_partitions,
+        )
+        # a semi join rather than an id filter, which could list hundreds of thousands
+        # of synapse ids
+        joins = [(lookup.select("id"), "id", "semi")]
+    else:
+        if pre_ids is not None:
+            pre_list = [pre_ids] if isinstance(pre_ids, (int,)) else list(pre_ids)
+            filters.append(("pre_pt_root_id", "in", pre_list))
+
+        if post_ids is not None:
+            filters += partitioned_id_filters(
+                "post_pt_root_id",
+                post_ids,
+                "post_pt_root_id_partition",
+                n_post_partitions,
+            )
+
+    if remove_autapses:
+        filters.append(("post_pt_root_id", "!=", ColumnRef("pre_pt_root_id")))
 
     if bounding_box is not None:
         min_corner, max_corner = bounding_box
-        x_col = f"{bounding_box_column}_x"
-        y_col = f"{bounding_box_column}_y"
-        z_col = f"{bounding_box_column}_z"
-        table = table.filter(
-            (pl.col(x_col) >= min_corner[0])
-            & (pl.col(x_col) <= max_corner[0])
-            & (pl.col(y_col) >= min_corner[1])
-            & (pl.col(y_col) <= max_corner[1])
-            & (pl.col(z_col) >= min_corner[2])
-            & (pl.col(z_col) <= max_corner[2])
-        )
+        for dim, min_value, max_value in zip("xyz", min_corner, max_corner):
+            filters.append((f"{bounding_box_column}_{dim}", ">=", min_value))
+            filters.append((f"{bounding_box_column}_{dim}", "<=", max_value))
 
-    return table.collect(engine="streaming")
+    return run_query(
+        query_path, filters=filters, columns=columns, joins=joins, engine=engine
+    )
 
 
 sample_roots = query_cell_info["pt_root_id"].sample(50).tolist()
@@ -108,18 +265,28 @@ print(polars_synapses.shape[0])
 print(materialization_synapses.shape[0])
 
 # %%
+# output connectivity, which uses the copy partitioned by pre_pt_root_id if the table
+# was written with one
+
 currtime = time.time()
+polars_output_synapses = synapse_query(
+    pre_ids=sample_roots,
+    columns=["id", "pre_pt_root_id", "post_pt_root_id", "size"],
+)
+print(f"{time.time() - currtime:.3f} seconds elapsed.")
+print(polars_output_synapses.shape[0])
 
-input_degrees = (
-    pl.scan_delta(
-        table_path,
-    )
-    .filter(
-        pl.col("post_pt_root_id").is_in(query_cell_info["pt_root_id"].unique()),
-    )
-    .group_by(["post_pt_root_id"])
-    .agg(pl.len().alias("n_synapses"))
-).collect(engine="streaming")
+# %%
+currtime = time.time()
+
+input_degrees = run_query(
+    table_path,
+    filters=[
+        ("post_pt_root_id", "in", query_cell_info["pt_root_id"].unique()),
+    ],
+    group_by=["post_pt_root_id"],
+    aggs={"n_synapses": ("count", None)},
+)
 print(f"{time.time() - currtime:.3f} seconds elapsed.")
 
 
@@ -127,16 +294,13 @@ print(f"{time.time() - currtime:.3f} seconds elapsed.")
 
 currtime = time.time()
 
-synapses = (
-    pl.scan_delta(
-        table_path,
-    )
-    .filter(
-        pl.col("post_pt_root_id").is_in(query_cell_info["pt_root_id"].unique()[:100]),
-        pl.col("post_pt_root_id") != pl.col("pre_pt_root_id"),
-    )
-    .select(["post_pt_root_id", "pre_pt_root_id", "size"])
-    .collect(engine="streaming")
+synapses = run_query(
+    table_path,
+    filters=[
+        ("post_pt_root_id", "in", query_cell_info["pt_root_id"].unique()[:100]),
+        ("post_pt_root_id", "!=", ColumnRef("pre_pt_root_id")),
+    ],
+    columns=["post_pt_root_id", "pre_pt_root_id", "size"],
 )
 
 print(f"{time.time() - currtime:.3f} seconds elapsed.")
@@ -144,20 +308,17 @@ print(f"{time.time() - currtime:.3f} seconds elapsed.")
 # %%
 currtime = time.time()
 
-synapse_sums = (
-    pl.scan_delta(
-        table_path,
-    )
-    .filter(
-        pl.col("post_pt_root_id").is_in(query_cell_info["pt_root_id"].unique()[:100]),
-        pl.col("post_pt_root_id") != pl.col("pre_pt_root_id"),
-    )
-    .group_by(["post_pt_root_id"])
-    .agg(
-        pl.col("size").mean().alias("input_mean_size"),
-        pl.col("size").std().alias("input_std_size"),
-    )
-    .collect(engine="streaming")
+synapse_sums = run_query(
+    table_path,
+    filters=[
+        ("post_pt_root_id", "in", query_cell_info["pt_root_id"].unique()[:100]),
+        ("post_pt_root_id", "!=", ColumnRef("pre_pt_root_id")),
+    ],
+    group_by=["post_pt_root_id"],
+    aggs={
+        "input_mean_size": ("mean", "size"),
+        "input_std_size": ("std", "size"),
+    },
 )
 
 print(f"{time.time() - currtime:.3f} seconds elapsed.")
@@ -0,0 +1,342 @@
+"""
+Manage CSV dump jobs for materialization tables.
+
+Dump requests for many tables are submitted concurrently. When the server reports that
+another operation is in progress, the request is retried with jittered exponential
+backoff. Completion is detected by polling the dump's location in the bucket, and each
+table is handed off for downloading and conversion as soon as its own dump lands,
+rather than waiting on every table.
+"""
+
+import asyncio
+import random
+import time
+from typing import Callable
+
+import requests
+from caveclient import CAVEclient
+from cloudpathlib import AnyPath as Path
+
+# allowance for clock differences between this machine and the bucket when checking
+# that a dump file is newer than its request
+MTIME_TOLERANCE_SECONDS = 60.0
+
+# how long to wait on the server to respond to a dump request before treating it as busy
+REQUEST_TIMEOUT_SECONDS = 60.0
+
+# outcomes of a single dump request
+DUMP_SUBMITTED = 1
+DUMP_BUSY = -1
+DUMP_FAILED = 0
+
+
+def get_dump_url(table_name: str, client: CAVEclient) -> str:
+    """
+    Get the materialization API endpoint which triggers a CSV dump of a table.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table to dump.
+    client : CAVEclient
+        An instance of CAVEclient to use for API access. Should have version set.
+    """
+    base_url = f"{client.info.get_datastack_info()['local_server']}/materialize"
+    endpoint = f"/api/v2/materialize/run/dump_csv_table/datastack/{client.datastack_name}/version/{client.version}/table_name/{table_name}/"
+    return base_url + endpoint
+
+
+def make_csv_dump_request(
+    url: str, headers: dict | None = None, timeout: float = REQUEST_TIMEOUT_SECONDS
+) -> int:
+    """
+    Make a single request to trigger a CSV dump for a materialization table.
+
+    Parameters
+    ----------
+    url : str
+        Endpoint to POST to, see `get_dump_url`.
+    headers : dict, optional
+        Headers to send, e.g. `client.auth.request_header`.
+    timeout : float
+        Seconds to wait to connect to the server and for it to respond.
+
+    Returns
+    -------
+    int
+        `DUMP_SUBMITTED` if the dump was started, `DUMP_BUSY` if another operation is
+        in progress or the server couldn't be reached and the request should be
+        retried, or `DUMP_FAILED` otherwise.
+    """
+    print(f"Making request to dump table via API: {url}")
+
+    # Make POST request with empty data like curl -d ''. This runs in a thread which
+    # can't be cancelled, so it needs a timeout to not hang the submit loop forever
+    try:
+        response = requests.post(url, headers=headers, data="", timeout=timeout)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        print(f"Could not reach the server: {e!r}")
+        return DUMP_BUSY
+
+    print(f"Response status code: {response.status_code}")
+
+    if response.status_code == 200:
+        return DUMP_SUBMITTED
+    else:
+        # Try to extract error message from JSON response
+        try:
+            error_data = response.json()
+            error_message = error_data.get("message", "No error message provided")
+
+            # Handle specific case where another operation is in progress
+            if (
+                response.status_code == 500
+                and "another operation was already in progress" in error_message.lower()
+            ):
+                print("Another operation is in progress. Server is busy.")
+                return DUMP_BUSY
+
+            # For other 500 errors, show the full response
+            elif response.status_code == 500:
+                print(f"Full error response: {error_data}")
+
+        except (ValueError, requests.exceptions.JSONDecodeError):
+            print("API returned an error but no JSON error message could be parsed")
+            print(f"Response text: {response.text}")
+
+        return DUMP_FAILED
+
+
+def backoff_delay(
+    attempt: int, base_seconds: float = 10.0, max_seconds: float = 300.0
+) -> float:
+    """
+    Delay before retry number `attempt`, using exponential backoff with full jitter.
+
+    Jitter keeps many waiting jobs from all retrying against the server at once.
+    """
+    return random.uniform(0, min(max_seconds, base_seconds * 2**attempt))
+
+
+async def submit_dump(
+    table_name: str,
+    url: str,
+    headers: dict | None = None,
+    max_wait_seconds: float = 3600.0,
+    backoff_base_seconds: float = 10.0,
+    backoff_max_seconds: float = 300.0,
+    request_timeout_seconds: float = REQUEST_TIMEOUT_SECONDS,
+) -> float:
+    """
+    Submit a dump request, retrying with backoff while the server is busy.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table, for logging.
+    url : str
+        Endpoint to POST to, see `get_dump_url`.
+    headers : dict, optional
+        Headers to send with the request.
+    max_wait_seconds : float
+        How long to keep retrying while the server is busy before giving up.
+    backoff_base_seconds, backoff_max_seconds : float
+        Parameters of the retry delay, see `backoff_delay`.
+    request_timeout_seconds : float
+        How long to wait on each request before retrying it.
+
+    Returns
+    -------
+    float
+        Time the dump was accepted, as given by `time.time()`.
+    """
+    start = time.time()
+    attempt = 0
+    while True:
+        submitted_at = time.time()
+        result = await asyncio.to_thread(
+            make_csv_dump_request, url, headers, request_timeout_seconds
+        )
+        if result == DUMP_SUBMITTED:
+            print(f"CSV dump for {table_name} triggered successfully!")
+            return submitted_at
+        elif result == DUMP_FAILED:
+            raise RuntimeError(f"Failed to trigger CSV dump for table {table_name}")
+
+        elapsed = time.time() - start
+        if elapsed >= max_wait_seconds:
+            raise TimeoutError(
+                f"Failed to trigger CSV dump for table {table_name} after waiting "
+                f"{elapsed:.0f} seconds. Please check the server status."
+            )
+        delay = min(
+            backoff_delay(attempt, backoff_base_seconds, backoff_max_seconds),
+            max_wait_seconds - elapsed,
+        )
+        print(f"Retrying dump of {table_name} in {delay:.1f} seconds...")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def dump_is_complete(paths: list, submitted_at: float) -> bool:
+    """
+    Check whether every file of a dump exists and was written after it was requested.
+
+    Parameters
+    ----------
+    paths : list of str or Path
+        Files the dump writes, e.g. the table and its header. Can be in a bucket or a
+        local directory.
+    submitted_at : float
+        Time the dump was requested. Older files are from a previous dump.
+    """
+    for path in paths:
+        path = Path(path)
+        if not path.exists():  # ty: ignore
+            return False
+        if path.stat().st_mtime < submitted_at - MTIME_TOLERANCE_SECONDS:  # ty: ignore
+            return False
+    return True
+
+
+async def wait_for_dump(
+    table_name: str,
+    paths: list,
+    submitted_at: float,
+    poll_seconds: float = 30.0,
+    max_wait_seconds: float = 6 * 3600.0,
+) -> None:
+    """
+    Wait until a dump has landed in the bucket, see `dump_is_complete`.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table, for logging.
+    paths : list of str or Path
+        Files the dump writes.
+    submitted_at : float
+        Time the dump was requested.
+    poll_seconds : float
+        Average time between checks of the bucket.
+    max_wait_seconds : float
+        How long to wait before giving up.
+    """
+    start = time.time()
+    while not await asyncio.to_thread(dump_is_complete, paths, submitted_at):
+        elapsed = time.time() - start
+        if elapsed >= max_wait_seconds:
+            raise TimeoutError(
+                f"CSV dump for table {table_name} did not appear at {paths} after "
+                f"{elapsed:.0f} seconds."
+            )
+        await asyncio.sleep(random.uniform(0.5, 1.5) * poll_seconds)
+    print(f"CSV dump for {table_name} landed after {time.time() - start:.0f} seconds.")
+
+
+async def dump_and_process(
+    table_name: str,
+    url: str,
+    paths: list,
+    process: Callable[[str], object] | None = None,
+    headers: dict | None = None,
+    submit_lock: asyncio.Lock | None = None,
+    backoff_base_seconds: float = 10.0,
+    backoff_max_seconds: float = 300.0,
+    max_submit_seconds: float = 3600.0,
+    request_timeout_seconds: float = REQUEST_TIMEOUT_SECONDS,
+    poll_seconds: float = 30.0,
+    max_wait_seconds: float = 6 * 3600.0,
+):
+    """
+    Dump one table, wait for it to land, then run `process(table_name)` on it.
+
+    `process` is run in a thread so that other tables' dumps keep being polled while
+    it runs. If `submit_lock` is given, it is held while submitting so that tables are
+    sent to the server one at a time. See `submit_dump` and `wait_for_dump` for the
+    remaining parameters.
+    """
+    if submit_lock is None:
+        submit_lock = asyncio.Lock()
+    async with submit_lock:
+        submitted_at = await submit_dump(
+            table_name,
+            url,
+            headers,
+            max_wait_seconds=max_submit_seconds,
+            backoff_base_seconds=backoff_base_seconds,
+            backoff_max_seconds=backoff_max_seconds,
+            request_timeout_seconds=request_timeout_seconds,
+        )
+
+    await wait_for_dump(
+        table_name,
+        paths,
+        submitted_at,
+        poll_seconds=poll_seconds,
+        max_wait_seconds=max_wait_seconds,
+    )
+
+    if process is None:
+        return None
+    return await asyncio.to_thread(process, table_name)
+
+
+async def _run_dump_jobs(jobs: dict, process, headers, serial_submit, **kwargs) -> dict:
+    submit_lock = asyncio.Lock() if serial_submit else None
+    tasks = {
+        table_name: asyncio.create_task(
+            dump_and_process(
+                table_name,
+                job["url"],
+                job["paths"],
+                process=process,
+                headers=headers,
+                submit_lock=submit_lock,
+                **kwargs,
+            )
+        )
+        for table_name, job in jobs.items()
+    }
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return {table_name: task.result() for table_name, task in tasks.items()}
+
+
+def run_dump_jobs(
+    jobs: dict,
+    process: Callable[[str], object] | None = None,
+    headers: dict | None = None,
+    serial_submit: bool = False,
+    **kwargs,
+) -> dict:
+    """
+    Dump many tables concurrently, processing each one as soon as its dump lands.
+
+    Parameters
+    ----------
+    jobs : dict
+        Maps each table name to a dict with the `"url"` to request its dump from (see
+        `get_dump_url`) and the `"paths"` of the files the dump writes.
+    process : callable, optional
+        Called with the table name once its dump has landed, e.g. to download and
+        unzip it. Runs in a worker thread.
+    headers : dict, optional
+        Headers to send with each dump request.
+    serial_submit : bool
+        Whether to submit dump requests one at a time rather than all at once.
+    **kwargs
+        Passed on to control retries and polling: `backoff_base_seconds`,
+        `backoff_max_seconds`, `max_submit_seconds`, `request_timeout_seconds`,
+        `poll_seconds` and `max_wait_seconds`.
+
+    Returns
+    -------
+    dict
+        Maps each table name to what `process` returned for it.
+    """
+    return asyncio.run(_run_dump_jobs(jobs, process, headers, serial_submit, **kwargs))
@@ -0,0 +1,343 @@
+"""
+Choose column types and Parquet encodings for writing a table to deltalake.
+
+Types from `build_polars_schema` are as wide as the SQL types they came from. Here
+each column other than ids is narrowed to a smaller type that holds every value in the
+table with room to spare, and the Parquet compression, page and row group sizes are
+picked by benchmarking file size against scan speed on a sample of the table.
+"""
+
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import polars as pl
+from deltalake.writer import BloomFilterProperties, ColumnProperties, WriterProperties
+
+# signed integer types from narrowest to widest, with the range each can hold. Delta
+# Lake has no unsigned integer types, and unsigned arrow columns are stored as the
+# signed type of the same width, so columns are only narrowed to signed types.
+INTEGER_DTYPES = [pl.Int8, pl.Int16, pl.Int32, pl.Int64]
+INTEGER_RANGES = {
+    pl.Int8: (-(2**7), 2**7 - 1),
+    pl.Int16: (-(2**15), 2**15 - 1),
+    pl.Int32: (-(2**31), 2**31 - 1),
+    pl.Int64: (-(2**63), 2**63 - 1),
+}
+
+# integer columns are narrowed to a type holding this many times their observed range,
+# so that later appends with somewhat larger values still fit the table's schema
+INTEGER_HEADROOM = 16
+
+# string columns with at most this fraction of distinct values are dictionary encoded,
+# above it the dictionary costs more than it saves
+DICTIONARY_MAX_DISTINCT_FRACTION = 0.1
+
+# (codec, level) pairs to benchmark, level None for codecs which don't take one
+CANDIDATE_COMPRESSIONS = [
+    ("snappy", None),
+    ("lz4", None),
+    ("zstd", 1),
+    ("zstd", 3),
+    ("zstd", 9),
+]
+
+# rows per row group and bytes per data page to benchmark
+CANDIDATE_ROW_GROUP_SIZES = [128 * 1024, 1024 * 1024]
+CANDIDATE_DATA_PAGE_SIZES = [1024 * 1024, 8 * 1024 * 1024]
+
+# names deltalake uses for the codecs polars calls by the names above
+DELTALAKE_COMPRESSIONS = {
+    "snappy": "SNAPPY",
+    "lz4": "LZ4_RAW",
+    "zstd": "ZSTD",
+    "gzip": "GZIP",
+    "brotli": "BROTLI",
+    "uncompressed": "UNCOMPRESSED",
+}
+
+
+def is_key_column(col: str) -> bool:
+    """
+    Whether a column holds ids, root ids or partitions, which are never narrowed. Their
+    values grow with later appends, and they are join keys against Int64 ids from CAVE
+    and pandas, which polars won't join on a narrower type.
+    """
+    return col == "id" or col.endswith("_id") or col.endswith("_partition")
+
+
+def smallest_integer_dtype(min_value, max_value) -> pl.DataType:
+    """Get the narrowest signed integer type which can hold every value in a range."""
+    for dtype in INTEGER_DTYPES:
+        low, high = INTEGER_RANGES[dtype]
+        if min_value >= low and max_value <= high:
+            return dtype
+    return pl.Int64
+
+
+def compute_column_stats(table: pl.LazyFrame) -> dict:
+    """
+    Compute what is needed to narrow each column's type, in one pass over the table.
+
+    Parameters
+    ----------
+    table : pl.LazyFrame
+        The full table, so that the chosen types are safe for every row.
+    """
+    schema = table.collect_schema()
+    aggs = [pl.len().alias("__n_rows")]
+    for col, dtype in schema.items():
+        if dtype.is_integer():
+            aggs.append(pl.col(col).min().alias(f"{col}__min"))
+            aggs.append(pl.col(col).max().alias(f"{col}__max"))
+        elif dtype == pl.Float64:
+            # whether every value survives a round trip through float32 unchanged
+            aggs.append(
+                (pl.col(col).cast(pl.Float32).cast(pl.Float64) == pl.col(col))
+                .all()
+                .alias(f"{col}__fits_float32")
+            )
+        elif dtype == pl.String:
+            aggs.append(pl.col(col).approx_n_unique().alias(f"{col}__n_unique"))
+    row = table.select(aggs).collect(engine="streaming").row(0, named=True)
+
+    n_rows = row.pop("__n_rows")
+    stats = {col: {} for col in schema}
+    for key, value in row.items():
+        col, stat = key.rsplit("__", 1)
+        stats[col][stat] = value
+    return {"n_rows": n_rows, "columns": stats, "schema": schema}
+
+
+def choose_column_encodings(
+    column_stats: dict,
+    dictionary_max_distinct_fraction: float = DICTIONARY_MAX_DISTINCT_FRACTION,
+    exclude_columns: list[str] | None = None,
+    integer_headroom: float = INTEGER_HEADROOM,
+) -> dict:
+    """
+    Choose the type and whether to dictionary encode each column.
+
+    Parameters
+    ----------
+    column_stats : dict
+        Output of `compute_column_stats`.
+    dictionary_max_distinct_fraction : float
+        String columns with at most this fraction of distinct values are dictionary
+        encoded.
+    exclude_columns : list of str, optional
+        Columns to keep the type of, e.g. partition columns, on top of the id columns
+        picked out by `is_key_column`.
+    integer_headroom : float
+        Integer columns are narrowed to a type holding this many times their observed
+        minimum and maximum.
+
+    Returns
+    -------
+    dict
+        Maps each column to a dict with the original `dtype`, the chosen `cast_to`
+        type, and whether the column is `dictionary` encoded.
+    """
+    n_rows = column_stats["n_rows"]
+    exclude_columns = set(exclude_columns or [])
+    encodings = {}
+    for col, dtype in column_stats["schema"].items():
+        stats = column_stats["columns"][col]
+        cast_to = dtype
+        dictionary = None
+        keep_type = col in exclude_columns or is_key_column(col)
+        if dtype.is_integer() and stats.get("min") is not None and not keep_type:
+            narrowest = smallest_integer_dtype(
+                stats["min"] * integer_headroom, stats["max"] * integer_headroom
+            )
+            if INTEGER_DTYPES.index(narrowest) < INTEGER_DTYPES.index(
+                dtype if dtype in INTEGER_DTYPES else pl.Int64
+            ):
+                cast_to = narrowest
+        elif dtype == pl.Float64 and stats.get("fits_float32") and not keep_type:
+            cast_to = pl.Float32
+        elif dtype == pl.String:
+            n_unique = stats.get("n_unique") or 0
+            dictionary = n_unique <= max(1, n_rows * dictionary_max_distinct_fraction)
+        encodings[col] = {
+            "dtype": str(dtype),
+            "cast_to": cast_to,
+            "dictionary": dictionary,
+        }
+    return encodings
+
+
+def apply_column_encodings(table: pl.LazyFrame, encodings: dict) -> pl.LazyFrame:
+    """Cast each column of a table to the type chosen for it."""
+    casts = [
+        pl.col(col).cast(encoding["cast_to"])
+        for col, encoding in encodings.items()
+        if str(encoding["cast_to"]) != encoding["dtype"]
+    ]
+    if len(casts) == 0:
+        return table
+    return table.with_columns(casts)
+
+
+def benchmark_parquet_options(
+    sample: pl.DataFrame,
+    compressions: list = CANDIDATE_COMPRESSIONS,
+    row_group_sizes: list[int] = CANDIDATE_ROW_GROUP_SIZES,
+    data_page_sizes: list[int] = CANDIDATE_DATA_PAGE_SIZES,
+    n_scans: int = 2,
+) -> list[dict]:
+    """
+    Write a sample of the table with each combination of Parquet options, and measure
+    the file size and how long it takes to read back.
+
+    Parameters
+    ----------
+    sample : pl.DataFrame
+        Sample of the table, with types already narrowed.
+    compressions : list of (str, int or None)
+        Codec and level pairs to try.
+    row_group_sizes : list of int
+        Rows per row group to try.
+    data_page_sizes : list of int
+        Bytes per data page to try.
+    n_scans : int
+        Number of times to read each file, the fastest is kept.
+    """
+    results = []
+    temp_dir = Path(tempfile.mkdtemp(prefix="encoding_benchmark_"))
+    try:
+        for codec, level in compressions:
+            for row_group_size in row_group_sizes:
+                for data_page_size in data_page_sizes:
+                    path = temp_dir / "sample.parquet"
+                    sample.write_parquet(
+                        path,
+                        compression=codec,
+                        compression_level=level,
+                        row_group_size=row_group_size,
+                        data_page_size=data_page_size,
+                    )
+                    scan_seconds = float("inf")
+                    for _ in range(n_scans):
+                        scan_time = time.perf_counter()
+                        pl.read_parquet(path)
+                        scan_seconds = min(
+                            scan_seconds, time.perf_counter() - scan_time
+                        )
+                    results.append(
+                        {
+                            "compression": codec,
+                            "compression_level": level,
+                            "row_group_size": row_group_size,
+                            "data_page_size": data_page_size,
+                            "file_bytes": path.stat().st_size,
+                            "scan_seconds": scan_seconds,
+                        }
+                    )
+                    path.unlink()
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def choose_parquet_options(results: list[dict], scan_time_weight: float = 1.0) -> dict:
+    """
+    Pick the benchmarked Parquet options with the best trade-off of size and speed.
+
+    Each option is scored by its file size and scan time relative to the smallest and
+    fastest seen, with `scan_time_weight` setting how much speed matters relative to
+    size. The lowest score wins.
+    """
+    min_bytes = min(result["file_bytes"] for result in results)
+    min_seconds = max(min(result["scan_seconds"] for result in results), 1e-9)
+
+    def score(result):
+        return (
+            result["file_bytes"] / min_bytes
+            + scan_time_weight * result["scan_seconds"] / min_seconds
+        )
+
+    return min(results, key=score)
+
+
+def build_writer_properties(
+    parquet_options: dict | None = None,
+    encodings: dict | None = None,
+    bloom_filter_columns: list[str] | None = None,
+    fpp: float = 0.001,
+    columns: list[str] | None = None,
+) -> WriterProperties | None:
+    """
+    Build deltalake writer properties from the chosen Parquet options, column
+    encodings and bloom filter columns.
+
+    Parameters
+    ----------
+    parquet_options : dict, optional
+        Output of `choose_parquet_options`. If not given, deltalake's defaults are
+        used.
+    encodings : dict, optional
+        Output of `choose_column_encodings`.
+    bloom_filter_columns : list of str, optional
+        Columns to add bloom filters to.
+    fpp : float
+        False positive probability for the bloom filters.
+    columns : list of str, optional
+        If given, only set properties for these columns, e.g. for a table holding a
+        subset of the columns.
+
+    Returns
+    -------
+    WriterProperties or None
+        None if nothing differs from deltalake's defaults.
+    """
+    encodings = encodings or {}
+    bloom_filter_columns = bloom_filter_columns or []
+    if columns is not None:
+        encodings = {col: enc for col, enc in encodings.items() if col in columns}
+        bloom_filter_columns = [col for col in bloom_filter_columns if col in columns]
+
+    column_properties = {}
+    for col in dict.fromkeys(list(encodings) + bloom_filter_columns):
+        dictionary = encodings.get(col, {}).get("dictionary")
+        bloom = col in bloom_filter_columns
+        if dictionary is None and not bloom:
+            continue
+        column_properties[col] = ColumnProperties(
+            dictionary_enabled=dictionary,
+            bloom_filter_properties=BloomFilterProperties(
+                set_bloom_filter_enabled=True, fpp=fpp
+            )
+            if bloom
+            else None,
+        )
+
+    if parquet_options is None and len(column_properties) == 0:
+        return None
+
+    kwargs = {}
+    if parquet_options is not None:
+        kwargs["compression"] = DELTALAKE_COMPRESSIONS[parquet_options["compression"]]
+        if parquet_options["compression_level"] is not None:
+            kwargs["compression_level"] = parquet_options["compression_level"]
+        kwargs["max_row_group_size"] = parquet_options["row_group_size"]
+        kwargs["data_page_size_limit"] = parquet_options["data_page_size"]
+    if len(column_properties) > 0:
+        kwargs["column_properties"] = column_properties
+    return WriterProperties(**kwargs)
+
+
+def encodings_to_metadata(encodings: dict, parquet_options: dict | None) -> dict:
+    """Make the chosen encodings JSON serializable, to record them on the table."""
+    return {
+        "columns": {
+            col: {
+                "dtype": encoding["dtype"],
+                "cast_to": str(encoding["cast_to"]),
+                "dictionary": encoding["dictionary"],
+            }
+            for col, encoding in encodings.items()
+        },
+        "parquet": parquet_options,
+    }
@@ -0,0 +1,306 @@
+"""
+Layout planning for writing materialization tables to deltalake.
+
+Picks the number of rows to process per chunk, the number of partitions, and the
+z-order/bloom filter columns from a sample of the CSV dump, rather than tuning these
+by hand for each table.
+"""
+
+import io
+import json
+import math
+import os
+
+import polars as pl
+
+# rough multiplier on the in-memory size of a chunk to account for the copies made
+# while collecting, adding the partition column, and encoding parquet during the write
+CHUNK_MEMORY_OVERHEAD = 4.0
+
+# fraction of the machine's memory to use when no explicit budget is given
+DEFAULT_MEMORY_FRACTION = 0.6
+
+# codec deltalake writes parquet with by default, used to measure how well a sample
+# compresses when no other codec has been chosen
+DEFAULT_COMPRESSION = "snappy"
+
+# bounds on the number of partitions to create
+MIN_PARTITIONS = 1
+MAX_PARTITIONS = 4096
+
+# maximum number of columns to z-order on, past which the curve stops clustering well
+MAX_ZORDER_COLUMNS = 3
+
+# table configuration key the chosen layout is recorded under
+LAYOUT_KEY = "registry.layout"
+
+# columns whose distinct fraction in the sample is above this are treated as
+# near-unique, for which bloom filters help point lookups more than min/max stats
+BLOOM_FILTER_MIN_DISTINCT_FRACTION = 0.5
+
+
+def parse_columns(columns_str: str) -> list[str]:
+    """Split a comma-separated string of column names, dropping empty entries."""
+    return [col.strip() for col in columns_str.split(",") if col.strip()]
+
+
+def get_memory_budget_bytes(memory_budget_gb: float | None = None) -> int:
+    """
+    Get the number of bytes of memory that processing is allowed to use.
+
+    Parameters
+    ----------
+    memory_budget_gb : float, optional
+        Explicit budget in GB. If not provided, a fraction of the total physical
+        memory of the machine is used.
+    """
+    if memory_budget_gb is not None:
+        return int(memory_budget_gb * 1e9)
+    total_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return int(total_memory * DEFAULT_MEMORY_FRACTION)
+
+
+def estimate_csv_rows(csv_path, n_sample_lines: int = 100_000) -> int:
+    """
+    Estimate the number of rows in a CSV file from the size of its first lines.
+
+    Parameters
+    ----------
+    csv_path : str or Path
+        Local path to an uncompressed CSV file without a header.
+    n_sample_lines : int
+        Number of lines to read to estimate the bytes per line.
+    """
+    file_size = os.path.getsize(csv_path)
+    n_lines = 0
+    n_bytes = 0
+    with open(csv_path, "rb") as f:
+        for line in f:
+            n_lines += 1
+            n_bytes += len(line)
+            if n_lines >= n_sample_lines:
+                break
+    if n_lines == 0:
+        return 0
+    if n_bytes >= file_size:
+        return n_lines
+    return int(file_size / (n_bytes / n_lines))
+
+
+def estimate_n_distinct(values: pl.Series, n_total: int) -> int:
+    """
+    Estimate the number of distinct values in a full column from a sample of it.
+
+    Uses the guaranteed-error estimator of Charikar et al. (2000), which scales up
+    the values seen exactly once in the sample and counts the rest as-is.
+
+    Parameters
+    ----------
+    values : pl.Series
+        Sample of the column.
+    n_total : int
+        Number of rows in the full column.
+    """
+    n_sample = len(values)
+    if n_sample == 0:
+        return 0
+    counts = values.value_counts(name="count")["count"]
+    n_singletons = int((counts == 1).sum())
+    n_repeated = int((counts > 1).sum())
+    scale = math.sqrt(max(n_total, n_sample) / n_sample)
+    return min(int(scale * n_singletons) + n_repeated, max(n_total, n_sample))
+
+
+def sample_evenly(
+    table: pl.LazyFrame, n_sample_rows: int, n_total_rows: int
+) -> pl.DataFrame:
+    """
+    Sample rows spread evenly across a whole table.
+
+    Dumps are ordered by id, so their first rows are close together in space and share
+    few root ids. A sample of them would under-estimate the number of distinct values
+    in each column and over-estimate how skewed they are.
+
+    Parameters
+    ----------
+    table : pl.LazyFrame
+        Table to sample. It is scanned once from start to end.
+    n_sample_rows : int
+        Number of rows to sample.
+    n_total_rows : int
+        Estimated number of rows in the table, used to space out the sample.
+    """
+    stride = max(1, n_total_rows // max(n_sample_rows, 1))
+    return table.gather_every(stride).head(n_sample_rows).collect(engine="streaming")
+
+
+def profile_sample(
+    sample: pl.DataFrame,
+    n_total_rows: int,
+    columns: list[str],
+    compression: str = DEFAULT_COMPRESSION,
+    compression_level: int | None = None,
+) -> dict:
+    """
+    Compute the size and cardinality statistics used for planning from a sample.
+
+    Parameters
+    ----------
+    sample : pl.DataFrame
+        Sample of the table, after any transformations applied before writing.
+    n_total_rows : int
+        Estimated number of rows in the full table.
+    columns : list of str
+        Columns to compute cardinality and skew for.
+    compression : str
+        Parquet codec the table will be written with, by its polars name.
+    compression_level : int, optional
+        Level for the codec, if it takes one.
+    """
+    n_sample = sample.height
+    if n_sample == 0:
+        raise ValueError("Cannot plan a layout from an empty sample.")
+
+    # measure what the sample actually compresses to as parquet, with the same codec
+    # the table will be written with
+    buffer = io.BytesIO()
+    sample.write_parquet(
+        buffer, compression=compression, compression_level=compression_level
+    )
+    parquet_bytes_per_row = buffer.getbuffer().nbytes / n_sample
+
+    column_stats = {}
+    for col in columns:
+        if col not in sample.columns:
+            continue
+        values = sample[col].drop_nulls()
+        if len(values) == 0:
+            continue
+        counts = values.value_counts(name="count")["count"]
+        n_distinct_sample = len(counts)
+        column_stats[col] = {
+            "distinct_fraction": n_distinct_sample / len(values),
+            "n_distinct_estimate": estimate_n_distinct(values, n_total_rows),
+            # share of rows held by the most common value, e.g. a root id with a huge
+            # number of synapses, which ends up in a single partition
+            "max_value_fraction": int(counts.max()) / len(values),
+        }
+
+    return {
+        "n_sample_rows": n_sample,
+        "n_rows_estimate": n_total_rows,
+        "memory_bytes_per_row": sample.estimated_size() / n_sample,
+        "parquet_bytes_per_row": parquet_bytes_per_row,
+        "columns": column_stats,
+    }
+
+
+def round_to_power_of_two(x: float) -> int:
+    """Round a positive number to the nearest power of two."""
+    if x <= 1:
+        return 1
+    return 2 ** round(math.log2(x))
+
+
+def plan_layout(
+    profile: dict,
+    partition_column: str,
+    query_columns: list[str],
+    memory_budget_bytes: int,
+    target_file_size_mb: float = 256,
+) -> dict:
+    """
+    Choose layout parameters for writing a table to deltalake.
+
+    Parameters
+    ----------
+    profile : dict
+        Output of `profile_sample`.
+    partition_column : str
+        Column which partitions are computed from.
+    query_columns : list of str
+        Columns that queries are expected to filter on, most important first.
+    memory_budget_bytes : int
+        Memory the conversion is allowed to use.
+    target_file_size_mb : float
+        Desired size of each parquet file. Each partition is z-ordered into roughly
+        one file, so this sets the number of partitions.
+
+    Returns
+    -------
+    dict
+        The chosen `n_rows_per_chunk`, `n_partitions`, `zorder_columns` and
+        `bloom_filter_columns`, along with the estimates they were based on.
+    """
+    n_rows = profile["n_rows_estimate"]
+    column_stats = profile["columns"]
+
+    # largest chunk that fits in memory, but no bigger than the table itself
+    chunk_bytes_per_row = profile["memory_bytes_per_row"] * CHUNK_MEMORY_OVERHEAD
+    n_rows_per_chunk = int(memory_budget_bytes / chunk_bytes_per_row)
+    n_rows_per_chunk = max(1, min(n_rows_per_chunk, n_rows))
+
+    # enough partitions to hit the target file size, but not more than there are
+    # distinct values to spread across them
+    table_bytes = n_rows * profile["parquet_bytes_per_row"]
+    n_partitions = round_to_power_of_two(table_bytes / (target_file_size_mb * 1e6))
+    if partition_column in column_stats:
+        n_distinct = column_stats[partition_column]["n_distinct_estimate"]
+        while n_partitions > 1 and n_partitions > n_distinct:
+            n_partitions //= 2
+    n_partitions = min(max(n_partitions, MIN_PARTITIONS), MAX_PARTITIONS)
+
+    # cluster on the partition column first, then on what queries filter by
+    zorder_columns = [partition_column]
+    for col in query_columns:
+        if col not in zorder_columns and col in column_stats:
+            zorder_columns.append(col)
+    zorder_columns = zorder_columns[:MAX_ZORDER_COLUMNS]
+
+    # bloom filters only pay off for point lookups on near-unique columns, which
+    # partition pruning and min/max statistics can't narrow down
+    bloom_filter_columns = [
+        col
+        for col in query_columns
+        if col != partition_column
+        and col in column_stats
+        and column_stats[col]["distinct_fraction"] > BLOOM_FILTER_MIN_DISTINCT_FRACTION
+    ]
+
+    warnings = []
+    if partition_column in column_stats:
+        max_value_fraction = column_stats[partition_column]["max_value_fraction"]
+        if max_value_fraction > 1 / n_partitions:
+            warnings.append(
+                f"Most common {partition_column} holds {max_value_fraction:.1%} of rows "
+                f"in the sample, so its partition will be larger than the others."
+            )
+
+    return {
+        "n_rows_per_chunk": n_rows_per_chunk,
+        "n_partitions": n_partitions,
+        "zorder_columns": zorder_columns,
+        "bloom_filter_columns": bloom_filter_columns,
+        "partition_column": partition_column,
+        "query_columns": query_columns,
+        "memory_budget_bytes": memory_budget_bytes,
+        "target_file_size_mb": target_file_size_mb,
+        "estimated_table_bytes": int(table_bytes),
+        "warnings": warnings,
+        "profile": profile,
+    }
+
+
+def layout_to_json(layout: dict) -> str:
+    """Serialize a layout so it can be stored in the table's configuration."""
+    return json.dumps(layout, sort_keys=True)
+
+
+def read_layout(configuration: dict) -> dict:
+    """
+    Get the layout recorded in a table's configuration, e.g.
+    `DeltaTable(path).metadata().configuration`, or an empty dict if there isn't one.
+    """
+    if LAYOUT_KEY not in configuration:
+        return {}
+    return json.loads(configuration[LAYOUT_KEY])
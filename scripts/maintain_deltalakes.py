@@ -0,0 +1,399 @@
+"""
+Background maintenance for registered deltalake tables.
+
+Walks every table under a root path and, for each one:
+
+1. Z-orders (or bin-packs, if the table has no recorded Z-order columns) only the
+   partitions which gained files since they were last optimized, so appends don't
+   accumulate small files.
+2. Writes a checkpoint of the transaction log once enough commits have built up since
+   the last one, and cleans up expired log entries.
+3. Vacuums files which are no longer referenced, keeping anything still needed by a
+   version within the retention window so that readers pinned to recent versions keep
+   working.
+
+Jobs are throttled to a fraction of wall time so that maintenance doesn't compete with
+query traffic.
+"""
+
+import json
+import os
+import time
+
+import polars as pl
+from cloudpathlib import AnyPath as Path
+from deltalake import DeltaTable
+
+from encoding_optimizer import build_writer_properties
+from layout_planner import parse_columns, read_layout
+
+# table configuration key recording when the table's files were last optimized. Kept in
+# the configuration rather than read from the commit history, which log cleanup and
+# deltalake's checkpoint hook delete once it expires
+OPTIMIZED_KEY = "registry.optimized"
+
+
+def find_delta_tables(root, max_depth: int = 4) -> list:
+    """
+    Find every deltalake table under a root path.
+
+    Parameters
+    ----------
+    root : str or Path
+        Local or cloud path to search under.
+    max_depth : int
+        How many directories deep to look for tables.
+    """
+    root = Path(root)
+    if (root / "_delta_log").exists():  # ty: ignore
+        return [root]
+    if max_depth == 0:
+        return []
+    tables = []
+    for child in sorted(root.iterdir()):  # ty: ignore
+        if child.is_dir() and not child.name.startswith("_"):
+            tables.extend(find_delta_tables(child, max_depth=max_depth - 1))
+    return tables
+
+
+def get_recorded_layout(dt: DeltaTable) -> dict:
+    """Get the layout recorded on a table when it was written, if any."""
+    return read_layout(dt.metadata().configuration)
+
+
+def optimized_to_json(
+    baseline_timestamp: int | None, partition_timestamps: dict | None = None
+) -> str:
+    """
+    Serialize when a table was last optimized so it can be stored in the table's
+    configuration under `OPTIMIZED_KEY`, see `get_last_optimized`.
+    """
+    partition_timestamps = partition_timestamps or {}
+    return json.dumps(
+        {
+            "baseline": baseline_timestamp,
+            # a partition rewritten before the whole table last was doesn't need its own
+            # entry any more
+            "partitions": {
+                json.dumps(partition_filters): timestamp
+                for partition_filters, timestamp in partition_timestamps.items()
+                if timestamp > (baseline_timestamp or -1)
+            },
+        },
+        sort_keys=True,
+    )
+
+
+def get_last_optimized(dt: DeltaTable) -> tuple[int | None, dict]:
+    """
+    Get when the table's files were last optimized, in milliseconds since the epoch.
+
+    Returns
+    -------
+    int or None
+        When the whole table was last optimized by the z-order at the end of a
+        conversion, or None if it never was.
+    dict
+        Maps partition filters, as a tuple, to when this worker last rewrote that
+        partition.
+    """
+    configuration = dt.metadata().configuration
+    if OPTIMIZED_KEY in configuration:
+        optimized = json.loads(configuration[OPTIMIZED_KEY])
+        partition_timestamps = {
+            tuple(tuple(f) for f in json.loads(partition_filters)): timestamp
+            for partition_filters, timestamp in optimized["partitions"].items()
+        }
+        return optimized["baseline"], partition_timestamps
+
+    # tables converted before this was recorded were z-ordered by their last OPTIMIZE
+    # commit, if it's still in the log
+    for commit in dt.history():
+        if commit.get("operation") == "OPTIMIZE":
+            return commit["timestamp"], {}
+    return None, {}
+
+
+def get_changed_partitions(
+    dt: DeltaTable,
+    baseline_timestamp: int | None = None,
+    partition_timestamps: dict | None = None,
+) -> list:
+    """
+    Get the partitions which have gained files since they were last optimized, and
+    have more than one file so could benefit from being rewritten.
+
+    Parameters
+    ----------
+    dt : DeltaTable
+        The table, at its latest version.
+    baseline_timestamp : int, optional
+        When the whole table was last optimized, see `get_last_optimized`. If None,
+        partitions never rewritten by this worker are considered changed.
+    partition_timestamps : dict, optional
+        When each partition was last rewritten by this worker, see
+        `get_last_optimized`.
+
+    Returns
+    -------
+    list of list of (str, str, str)
+        Partition filters, one for each changed partition, in the form deltalake's
+        optimize methods expect. An unpartitioned table gives a single empty filter.
+    """
+    partition_timestamps = partition_timestamps or {}
+    partition_columns = dt.metadata().partition_columns
+    partition_keys = [f"partition.{col}" for col in partition_columns]
+
+    actions = pl.DataFrame(dt.get_add_actions(flatten=True)).with_columns(
+        pl.col("modification_time").dt.epoch("ms").alias("modified")
+    )
+    if len(partition_keys) > 0:
+        partitions = actions.group_by(partition_keys).agg(
+            pl.len().alias("n_files"), pl.col("modified").max()
+        )
+    else:
+        partitions = actions.select(pl.len().alias("n_files"), pl.col("modified").max())
+
+    changed = []
+    for row in partitions.iter_rows(named=True):
+        if row["n_files"] <= 1:
+            continue
+        partition_filters = [
+            (col, "=", str(row[key]))
+            for col, key in zip(partition_columns, partition_keys)
+        ]
+        # files are written before the commit adding them, so anything written after
+        # the partition was last optimized was added since
+        last_optimized = max(
+            baseline_timestamp or -1,
+            partition_timestamps.get(tuple(partition_filters), -1),
+        )
+        if row["modified"] > last_optimized:
+            changed.append(partition_filters)
+    return changed
+
+
+def get_versions_since_checkpoint(dt: DeltaTable) -> int:
+    """Get how many commits have been made since the last checkpoint was written."""
+    last_checkpoint_path = Path(dt.table_uri) / "_delta_log" / "_last_checkpoint"
+    if last_checkpoint_path.exists():  # ty: ignore
+        last_checkpoint = json.loads(last_checkpoint_path.read_text())  # ty: ignore
+        return dt.version() - last_checkpoint["version"]
+    return dt.version() + 1
+
+
+class Throttle:
+    """
+    Keeps jobs to a fraction of wall time, by sleeping after each job for as long as
+    it takes to bring the fraction of time spent working back down to `duty_cycle`.
+    """
+
+    def __init__(self, duty_cycle: float = 0.5, min_pause_seconds: float = 0.0):
+        if not 0 < duty_cycle <= 1:
+            raise ValueError(f"duty_cycle must be in (0, 1], got {duty_cycle}")
+        self.duty_cycle = duty_cycle
+        self.min_pause_seconds = min_pause_seconds
+
+    def run(self, job, *args, **kwargs):
+        start = time.time()
+        try:
+            return job(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            pause = max(elapsed * (1 / self.duty_cycle - 1), self.min_pause_seconds)
+            if pause > 0:
+                time.sleep(pause)
+
+
+def maintain_table(
+    table_path,
+    throttle: Throttle,
+    retention_hours: float = 168,
+    checkpoint_interval: int = 10,
+    target_file_size_mb: float | None = None,
+    max_partitions: int | None = None,
+    max_concurrent_tasks: int = 1,
+) -> dict:
+    """
+    Run every maintenance job on one table.
+
+    Parameters
+    ----------
+    table_path : str or Path
+        Location of the table.
+    throttle : Throttle
+        Used to run each job, to limit how much time is spent on maintenance.
+    retention_hours : float
+        Files needed by any version committed within this many hours are kept by the
+        vacuum, so that readers pinned to those versions keep working.
+    checkpoint_interval : int
+        Write a checkpoint once at least this many commits have been made since the
+        last one.
+    target_file_size_mb : float, optional
+        Size of the files to rewrite partitions into. Defaults to the target recorded in
+        the table's layout, or deltalake's default if there isn't one.
+    max_partitions : int, optional
+        Most partitions to rewrite in this run. The rest are picked up in later runs.
+    max_concurrent_tasks : int
+        Threads deltalake may use for each rewrite, kept low to leave room for queries.
+
+    Returns
+    -------
+    dict
+        Summary of what was done.
+    """
+    table_path = str(table_path)
+    dt = DeltaTable(table_path)
+    layout = get_recorded_layout(dt)
+    summary = {"table": table_path, "start_version": dt.version()}
+
+    # rewrite the partitions that changed since the table was last optimized
+    baseline_timestamp, partition_timestamps = get_last_optimized(dt)
+    changed_partitions = get_changed_partitions(
+        dt, baseline_timestamp, partition_timestamps
+    )
+    summary["n_changed_partitions"] = len(changed_partitions)
+    if max_partitions is not None:
+        changed_partitions = changed_partitions[:max_partitions]
+
+    if target_file_size_mb is None:
+        target_file_size_mb = layout.get("target_file_size_mb")
+    target_size = int(target_file_size_mb * 1e6) if target_file_size_mb else None
+
+    encodings = layout.get("encodings", {})
+    writer_properties = build_writer_properties(
+        encodings.get("parquet"),
+        encodings.get("columns"),
+        layout.get("bloom_filter_columns"),
+        fpp=layout.get("fpp", 0.001),
+    )
+    zorder_columns = layout.get("zorder_columns", [])
+
+    n_rewritten = 0
+    try:
+        for partition_filters in changed_partitions:
+            kwargs = dict(
+                partition_filters=partition_filters or None,
+                target_size=target_size,
+                max_concurrent_tasks=max_concurrent_tasks,
+                writer_properties=writer_properties,
+            )
+            if len(zorder_columns) > 0:
+                print(f"Z-ordering {table_path} partition {partition_filters}...")
+                throttle.run(dt.optimize.z_order, zorder_columns, **kwargs)
+            else:
+                print(f"Compacting {table_path} partition {partition_filters}...")
+                throttle.run(dt.optimize.compact, **kwargs)
+            # the rewritten files were all written before now
+            partition_timestamps[tuple(tuple(f) for f in partition_filters)] = int(
+                time.time() * 1000
+            )
+            n_rewritten += 1
+    finally:
+        # recorded in a single commit per run, including for partitions rewritten
+        # before a failure, and for tables whose baseline was read from the history
+        optimized_json = optimized_to_json(baseline_timestamp, partition_timestamps)
+        if dt.metadata().configuration.get(OPTIMIZED_KEY) != optimized_json:
+            dt.alter.set_table_properties(
+                {OPTIMIZED_KEY: optimized_json}, raise_if_not_exists=False
+            )
+    summary["n_rewritten_partitions"] = n_rewritten
+
+    # checkpoint the transaction log so readers don't replay every commit, and delete
+    # the log entries the checkpoint makes redundant once they expire
+    dt = DeltaTable(table_path)
+    summary["checkpointed"] = False
+    if get_versions_since_checkpoint(dt) >= checkpoint_interval:
+        print(f"Writing checkpoint for {table_path} at version {dt.version()}...")
+        throttle.run(dt.create_checkpoint)
+        throttle.run(dt.cleanup_metadata)
+        summary["checkpointed"] = True
+
+    # delete files no version within the retention window needs
+    print(f"Vacuuming {table_path} with {retention_hours} hour retention...")
+    deleted = throttle.run(
+        dt.vacuum,
+        retention_hours=retention_hours,
+        dry_run=False,
+        enforce_retention_duration=False,
+    )
+    summary["n_vacuumed_files"] = len(deleted)
+    summary["end_version"] = dt.version()
+
+    return summary
+
+
+def main():
+    # PARAMETERS
+    # ----------
+
+    # root to search for tables under, e.g. gs://cave_annotation_bucket/cistern/
+    registry_root = os.getenv("REGISTRY_ROOT")
+
+    # or an explicit comma-separated list of table paths
+    table_paths = parse_columns(os.getenv("TABLE_PATHS", ""))
+
+    if not registry_root and not table_paths:
+        raise ValueError("One of REGISTRY_ROOT or TABLE_PATHS must be set.")
+
+    # files needed by versions committed within this window are kept by the vacuum.
+    # deltalake's default is 7 days.
+    retention_hours = float(os.getenv("RETENTION_HOURS", "168"))
+
+    # write a checkpoint once this many commits have been made since the last one
+    checkpoint_interval = int(os.getenv("CHECKPOINT_INTERVAL", "10"))
+
+    # most partitions to rewrite per table per run, empty for no limit
+    max_partitions = os.getenv("MAX_PARTITIONS_PER_RUN")
+    max_partitions = int(max_partitions) if max_partitions else None
+
+    # threads deltalake may use for each rewrite
+    max_concurrent_tasks = int(os.getenv("MAX_CONCURRENT_TASKS", "1"))
+
+    # fraction of wall time to spend running jobs, and the least time to pause between
+    # them, to leave room for query traffic
+    duty_cycle = float(os.getenv("DUTY_CYCLE", "0.5"))
+    min_pause_seconds = float(os.getenv("MIN_PAUSE_SECONDS", "0"))
+
+    # minutes between passes over every table, 0 to only make one pass
+    interval_minutes = float(os.getenv("MAINTENANCE_INTERVAL_MINUTES", "0"))
+
+    throttle = Throttle(duty_cycle=duty_cycle, min_pause_seconds=min_pause_seconds)
+
+    while True:
+        pass_time = time.time()
+
+        if registry_root:
+            tables = find_delta_tables(registry_root) + table_paths
+        else:
+            tables = table_paths
+        print(f"Found {len(tables)} tables to maintain.")
+
+        for table_path in tables:
+            table_time = time.time()
+            try:
+                summary = maintain_table(
+                    table_path,
+                    throttle,
+                    retention_hours=retention_hours,
+                    checkpoint_interval=checkpoint_interval,
+                    max_partitions=max_partitions,
+                    max_concurrent_tasks=max_concurrent_tasks,
+                )
+                print(summary)
+            except Exception as e:
+                # keep going, one broken table shouldn't stop the others being
+                # maintained
+                print(f"Failed to maintain {table_path}: {e!r}")
+            print(f"{time.time() - table_time:.3f} seconds elapsed for {table_path}.")
+            print()
+
+        print(f"{time.time() - pass_time:.3f} seconds elapsed for maintenance pass.")
+
+        if interval_minutes <= 0:
+            break
+        time.sleep(max(0, interval_minutes * 60 - (time.time() - pass_time)))
+
+
+if __name__ == "__main__":
+    main()